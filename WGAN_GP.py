@@ -16,7 +16,7 @@ import torchvision
 from torchvision import datasets, models, transforms
 import torchvision.utils as vutils
 from ecbm6040.dataloader.CustomDatasetFromCSV import CustomDatasetFromCSV
-from ecbm6040.patching.patchloader import patching, depatching
+from ecbm6040.patching.patchloader import patching, depatching, CudaPrefetcher
 from ecbm6040.metric.eval_metrics import ssim, psnr, nrmse
 
 class WGAN_GP(object): 
@@ -36,8 +36,9 @@ class WGAN_GP(object):
              supervised_criterion, D_criterion, 
              device, ngpu,
              lr=5e-6, joint_opt_param=0.001):
-        self.netG = netG
-        self.netD = netD
+        # channels_last_3d weights let cuDNN pick the NDHWC conv3d kernels, the layout is kept by load_state_dict
+        self.netG = netG.to(memory_format=torch.channels_last_3d)
+        self.netD = netD.to(memory_format=torch.channels_last_3d)
         self.supervised_criterion = supervised_criterion
         self.D_criterion = D_criterion
         self.device = device
@@ -292,11 +293,10 @@ class WGAN_GP(object):
                             patch_loader=patching(lr_data, hr_data, 
                                                   patch_size = patch_size, 
                                                   cube_size = cube_size, 
-                                                  usage=1.0, is_training=False)
+                                                  usage=1.0, is_training=False,
+                                                  device=self.device)
                             sr_data_cat = torch.Tensor([]) # for concatenation
-                        for lr_patches, hr_patches in patch_loader:
-                            lr_patches=lr_patches.cuda(self.device)
-                            hr_patches=hr_patches.cuda(self.device)
+                        for lr_patches, hr_patches in CudaPrefetcher(patch_loader, self.device):
                             # zero the parameter gradients
                             self.optimizerG.zero_grad()
                             self.optimizerD.zero_grad()
@@ -492,11 +492,10 @@ class WGAN_GP(object):
             patch_loader=patching(lr_data, hr_data, 
                            patch_size = patch_size, 
                            cube_size = cube_size, 
-                           usage=1.0, is_training=False)
+                           usage=1.0, is_training=False,
+                           device=self.device)
             sr_data_cat = torch.Tensor([]) # for concatenation
-            for lr_patches, hr_patches in patch_loader:
-                lr_patches=lr_patches.cuda(self.device)
-                hr_patches=hr_patches.cuda(self.device)
+            for lr_patches, hr_patches in CudaPrefetcher(patch_loader, self.device):
                 # zero the parameter gradients
                 self.optimizerG.zero_grad()
                 self.optimizerD.zero_grad()
@@ -505,10 +504,6 @@ class WGAN_GP(object):
                     # statistics
                     # concatenate patches, send patches to cpu to save GPU memory
                     sr_data_cat = torch.cat([sr_data_cat, sr_patches.to("cpu")],0)
-            print(sr_data_cat.dtype)
-            print('calculate the evaluation metric')
-            print(sr_data_cat.size())
-            print(lr_data.size(0))
             sr_data = depatching(sr_data_cat, lr_data.size(0))
             batch_ssim = ssim(hr_data, sr_data)
             batch_psnr = psnr(hr_data, sr_data)
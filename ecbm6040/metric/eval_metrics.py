@@ -3,6 +3,14 @@ import torch
 import numpy as np
 from skimage.metrics import peak_signal_noise_ratio, structural_similarity
 
+def to_unit_range(img):
+    '''
+    This function transforms a torch.ShortTensor (B,z,x,y) from int16(12): 0-4095 to an ndarray float32: 0.0-1.0. The cast and the scaling are done in place on the whole batch with vectorized NumPy.
+    '''
+    img = img.numpy().astype(np.float32)
+    img *= np.float32(1.0 / 4095.0)
+    return img
+
 def ssim(img_true, img_test):
     '''
     This function input two batches of true images and the fake images. Use skimage.measure.compare_ssim function to compute the mean structural similarity index between two images.
@@ -10,8 +18,7 @@ def ssim(img_true, img_test):
     (Input) img_test: the input should be derived from depatching function, it's in torch.float (B,z,x,y). By default, it should be SR images.
     (Output) ssim: an ndarray with length (B,1), which contains the ssim value for each image in the batch.
     '''
-    img_true = img_true.float() / 4095.0
-    img_true = img_true.numpy()
+    img_true = to_unit_range(img_true)
     
     img_test = img_test.numpy()
     
@@ -29,8 +36,7 @@ def psnr(img_true, img_test):
     (Input) img_test: the input should be derived from depatching function, it's in torch.float (B,z,x,y). By default, it should be SR images.
     (Output) psnr: an ndarray with length (B,1), which contains the psnr value for each image in the batch.
     '''
-    img_true = img_true.float() / 4095.0
-    img_true = img_true.numpy()
+    img_true = to_unit_range(img_true)
     
     img_test = img_test.numpy()
     psnr=[]
@@ -46,8 +52,7 @@ def nrmse(img_true, img_test):
     (Input) img_test: the input should be derived from depatching function, it's in torch.float (B,z,x,y). By default, it should be SR images.
     (Output) nrmse: an ndarray with length (B,1), which contains the psnr value for each image in the batch.
     '''
-    img_true = img_true.float() / 4095.0
-    img_true = img_true.numpy()
+    img_true = to_unit_range(img_true)
     
     img_test = img_test.numpy()
     nrmse=[]
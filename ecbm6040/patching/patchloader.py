@@ -1,41 +1,176 @@
 ## This file includes all the operations in patching. It can efficiently process patching with as small computation cost as possible.
+import os
+import functools
+import logging
 import torch
-import numpy as np
+import torch.nn.functional as F
 import torchvision
 from torchvision import datasets, models, transforms
 from torch.utils.data.dataset import Dataset
-from torch.utils.data.sampler import SequentialSampler
+from torch.utils.data.sampler import Sampler
 import scipy.io
 
-# Patch class for function 'patching'. It can get an item at a time.
+logger = logging.getLogger(__name__)
+
+# Patch class for function 'patching'. It can get a batch of patches at a time with a slice from PatchBatchSampler,
+# or a single patch with an int index.
 class Patch(Dataset):
     def __init__(self, lr_patches, hr_patches):
         self.lr_data = lr_patches
         self.hr_data = hr_patches
+        self._len = lr_patches.shape[0] # the length is asked by DataLoader often, so keep it
        
-    def transform(self, image):
-        '''
-        This function transforms the input patch (64,64,64) 
-        from int16(12): 0-4095 to float: 0.0-1.0
-        
-        '''
-        image_float = image.float() / 4095.0
-        image_float = torch.unsqueeze(image_float,0)
-        return image_float
     def __getitem__(self, idx):
-        image_lr = self.lr_data[idx,:,:,:]
-        image_hr = self.hr_data[idx,:,:,:]
-        sample_hr = self.transform(image_hr)
-        sample_lr = self.transform(image_lr)
+        # For a slice from PatchBatchSampler the whole batch is sliced at once as int16 (B,1,64,64,64),
+        # for an int index one patch (1,64,64,64) is returned. The channel dim goes before the 3 spatial dims.
+        # The dtype transform is left to 'patch_to_device', so that only int16 is copied to GPU.
+        image_lr = self.lr_data[idx]
+        image_hr = self.hr_data[idx]
+        return (image_lr.unsqueeze(image_lr.dim() - 3), image_hr.unsqueeze(image_hr.dim() - 3))
+    def __len__(self):
+        return self._len
+
+# PatchBatchSampler class for function 'patching'. It yields one slice of patch indices per batch.
+class PatchBatchSampler(Sampler):
+    def __init__(self, num_patches, batch_size):
+        self.num_patches = num_patches
+        self.batch_size = batch_size
+        
+    def __iter__(self):
+        for start in range(0, self.num_patches, self.batch_size):
+            yield slice(start, min(start + self.batch_size, self.num_patches))
+    def __len__(self):
+        return (self.num_patches + self.batch_size - 1) // self.batch_size
+
+def patch_to_device(patches, device, dtype = torch.float32):
+    '''
+    This function sends a batch of int16(12) patches (B,1,64,64,64) to the device, and transforms it there
+    from int16(12): 0-4095 to float: 0.0-1.0.
+    Set dtype to torch.bfloat16 or torch.float16 to get half precision patches directly, e.g. under torch.cuda.amp.autocast.
+    
+    '''
+    patches = patches.to(device, non_blocking=True)
+    return normalize_patches(patches, dtype)
+
+def normalize_patches(patches, dtype = torch.float32):
+    '''
+    This function transforms int16(12) patches from 0-4095 to float: 0.0-1.0.
+    
+    '''
+    # the cast always makes a new tensor from int16, so scaling it in place is safe and saves a temporary
+    return patches.to(dtype).mul_(1.0 / 4095.0)
+
+# the cast and the scaling are fused into one pass over memory.
+normalize_patches = torch.compile(normalize_patches, dynamic=False)
+
+# CudaPrefetcher class for the patch loaders from function 'patching'.
+class CudaPrefetcher(object):
+    '''
+    This class wraps a patch loader, and sends the next batch of patches to GPU by 'patch_to_device' on a side CUDA stream,
+    so that the host to device copy overlaps with the computation on the current batch.
+    
+    '''
+    def __init__(self, loader, device, dtype = torch.float32):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.dtype = dtype
+        self.stream = torch.cuda.Stream(device=self.device)
         
-        return (sample_lr, sample_hr)
+    def preload(self, batches):
+        try:
+            lr_patches, hr_patches = next(batches)
+        except StopIteration:
+            return None
+        # the patches may be made on the current stream (e.g. by 'patching' with device), wait for them first
+        self.stream.wait_stream(torch.cuda.current_stream(self.device))
+        with torch.cuda.stream(self.stream):
+            lr_patches = patch_to_device(lr_patches, self.device, self.dtype)
+            hr_patches = patch_to_device(hr_patches, self.device, self.dtype)
+        return (lr_patches, hr_patches)
+    def __iter__(self):
+        batches = iter(self.loader)
+        next_batch = self.preload(batches)
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            lr_patches, hr_patches = next_batch
+            # the patches are made on the side stream, tell the allocator they are used on the current stream
+            lr_patches.record_stream(current_stream)
+            hr_patches.record_stream(current_stream)
+            next_batch = self.preload(batches)
+            yield (lr_patches, hr_patches)
     def __len__(self):
-        return self.lr_data.shape[0]
+        return len(self.loader)
+
+@functools.lru_cache(maxsize=None)
+def load_idx_mine():
+    '''
+    This function loads the unwanted patch indices from idx_mine.mat. The file is only read once, later calls return the cached tuple.
     
+    '''
+    mat = scipy.io.loadmat(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'idx_mine.mat'))
+    return tuple(mat['idx_mine'][0].tolist())
 
-def patching(lr_data, hr_data, patch_size = 2, cube_size = 64, usage = 1.0, margin =3, is_training=True):
+def cube_view(data, cube_size = 64, stride = 64):
     '''
-    This function makes patches from the input 3D image. It fulfills random patch selection for training period, and sliding window patch seperation for evaluation period. Note that dtype transform from int16(12): 0-4095 to float: 0.0-1.0 is applied on patches in order to save memory.
+    This function builds a zero-copy strided view of all the cubes in the input 3D image. It is equivalent to applying unfold on dims 1, 2, 3, but no data is copied until the cubes are indexed.
+
+    (Input) data: a torch.Tensor (B,z,x,y).
+    (Input) cube_size: define the 3D cube size. 64 in this project (Default).
+    (Input) stride: the step between two neighbouring cubes.
+    (Output) cubes: a strided view of data with size (B,nz,nx,ny,cube_size,cube_size,cube_size).
+    '''
+    s0, s1, s2, s3 = data.stride()
+    shape = (data.shape[0],
+             (data.shape[1] - cube_size) // stride + 1,
+             (data.shape[2] - cube_size) // stride + 1,
+             (data.shape[3] - cube_size) // stride + 1,
+             cube_size, cube_size, cube_size)
+    strides = (s0, stride * s1, stride * s2, stride * s3, s1, s2, s3)
+    return data.as_strided(shape, strides)
+
+def gather_cubes(indices, *cubes):
+    '''
+    This function copies only the selected cubes out of the strided views from 'cube_view'. The views must have the same number of cubes,
+    e.g. the l/hr views of one batch, so that the indices are unravelled once and used for all of them.
+
+    (Input) indices: a torch.LongTensor of flat patch indices, in the order of (B,nz,nx,ny) flattened.
+    (Input) cubes: strided views (B,nz,nx,ny,c,c,c) from 'cube_view'.
+    (Output) patches: a tuple of torch.Tensor (len(indices),c,c,c), one for each view.
+    '''
+    nz, nx, ny = cubes[0].shape[1:4]
+    b, rest = indices // (nz * nx * ny), indices % (nz * nx * ny)
+    iz, rest = rest // (nx * ny), rest % (nx * ny)
+    ix, iy = rest // ny, rest % ny
+    return tuple(view[b, iz, ix, iy] for view in cubes)
+
+def flatten_cubes(cubes):
+    '''
+    This function copies all the cubes of the strided view from 'cube_view' into contiguous patches (N,c,c,c).
+    
+    '''
+    cube_size = cubes.shape[-1]
+    return cubes.contiguous().view(-1, cube_size, cube_size, cube_size)
+
+def build_eval_patches(lr_data, hr_data, cube_size = 64, stride = 58, padding = (20, 17, 17)):
+    '''
+    This function pads the input 3D image, and copies all the sliding window cubes into patches (N,c,c,c) for evaluation period.
+    
+    '''
+    pad = (padding[2], padding[2], padding[1], padding[1], padding[0], padding[0])
+    # keep int16 here since the dtype transform is done per batch in 'patch_to_device'
+    lr_patches = flatten_cubes(cube_view(F.pad(lr_data, pad), cube_size, stride))
+    hr_patches = flatten_cubes(cube_view(F.pad(hr_data, pad), cube_size, stride))
+    return lr_patches, hr_patches
+
+# all the sizes are fixed in evaluation period, so padding, cube view and copy are compiled into one
+# shape-specialized graph, the first call compiles and later calls reuse the cached kernels.
+build_eval_patches = torch.compile(build_eval_patches, fullgraph=True, dynamic=False)
+
+def patching(lr_data, hr_data, patch_size = 2, cube_size = 64, usage = 1.0, margin =3, is_training=True, 
+             num_workers = 0, pin_memory = True, persistent_workers = False, prefetch_factor = 2, device = None):
+    '''
+    This function makes patches from the input 3D image. It fulfills random patch selection for training period, and sliding window patch seperation for evaluation period. Note that patches are kept in int16 to save memory, and dtype transform from int16(12): 0-4095 to float: 0.0-1.0 is applied on each batch of patches on GPU by 'patch_to_device'.
 
     (Input) l/hr_data: a torch.ShortTensor (B,z,x,y) with dtype=int16 (the exact dtype is int12, from 0-4095)
     (Input) patch_size: define the patch size. 2 in this project (Default).
@@ -43,56 +178,81 @@ def patching(lr_data, hr_data, patch_size = 2, cube_size = 64, usage = 1.0, marg
     (Input) usage: The percentage of usage of one cluster of patches. For example: usage= 0.5 means to randomly pick 50% patches from a cluster of 200 patches.
     (Input) margin: The size that one patch has to be cut off. Only implemented in evaluation period. 3 in this project (Default).               
     (Input) is_training: True for training and validation set, False for evaluation and test set.
-    (Output) patch_loader: a torch.DataLoader for picking patches from one batch.
+    (Input) num_workers: the number of worker processes of the returned DataLoader. 0 in this project (Default), since one batch is a single slice of in-memory patches and a new DataLoader is made for every batch of images, so workers would only add process start-up and inter-process copies.
+    (Input) pin_memory: True to put the patches in pinned memory once, so that the copy to GPU can be overlapped with computation. The batches are slices of them, so they are pinned as well (with num_workers > 0 the DataLoader pins them again instead). Use 'patch_to_device' (a non_blocking copy) or 'CudaPrefetcher' on the patches to benefit from it.
+    (Input) persistent_workers: True to keep the workers alive after the DataLoader is consumed. Only useful when the same DataLoader is iterated more than once.
+    (Input) prefetch_factor: the number of batches loaded in advance by each worker. Only used when num_workers > 0.
+    (Input) device: the device where padding and patching are done, and where the patches are kept. None to keep them on CPU (Default). For a CUDA device, the DataLoader uses no worker and no pinned memory since GPU tensors can't be shared with worker processes.
+    (Output) patch_loader: a torch.DataLoader for picking int16 patches (B,1,64,64,64) from one batch.
     '''
-    #import idx_mine to avoid unwanted patch indices
-    mat = scipy.io.loadmat('ecbm6040/patching/idx_mine.mat')
-    idx_mine = mat['idx_mine']
-    idx_mine = idx_mine[0].tolist()
+    if device is not None:
+        lr_data = lr_data.to(device, non_blocking=True)
+        hr_data = hr_data.to(device, non_blocking=True)
+        if torch.device(device).type == 'cuda':
+            num_workers = 0
+            pin_memory = False
+    pin_memory = pin_memory and torch.cuda.is_available()
+    loader_kwargs = {'num_workers': num_workers}
+    if num_workers > 0:
+        # batches from workers come through shared memory, so they have to be pinned again by the DataLoader
+        loader_kwargs.update(persistent_workers=persistent_workers, prefetch_factor=prefetch_factor, pin_memory=pin_memory)
     # here we are not setting mines. We want all patches.
+    # To avoid unwanted patch indices, use idx_mine = load_idx_mine() instead.
     idx_mine = []
     
     if is_training:
         stride = cube_size # patch stride
-        lr_patches = lr_data.unfold(1, cube_size, stride).unfold(2, cube_size, stride).unfold(3, cube_size, stride)
-        hr_patches = hr_data.unfold(1, cube_size, stride).unfold(2, cube_size, stride).unfold(3, cube_size, stride)
-        lr_patches = lr_patches.contiguous().view(-1, cube_size, cube_size, cube_size)
-        hr_patches = hr_patches.contiguous().view(-1, cube_size, cube_size, cube_size)
-        patches = Patch(lr_patches, hr_patches)
-        num_patches = len(patches)
+        lr_cubes = cube_view(lr_data, cube_size, stride)
+        hr_cubes = cube_view(hr_data, cube_size, stride)
+        num_patches = lr_cubes.shape[0] * lr_cubes.shape[1] * lr_cubes.shape[2] * lr_cubes.shape[3]
         patch_split= usage # define the percentage of selecting patches in a batch
         patch_take = int(patch_split * num_patches) # the total patches selected in a batch 
-        indices_undemined = list(range(num_patches))
-        indices= list(set(indices_undemined) - set(idx_mine)) # exclude unwanted patch indices
-        np.random.shuffle(indices)
-        patch_indices = indices[:patch_take]
-        patch_sampler = SequentialSampler(patch_indices)
+        if idx_mine:
+            # exclude unwanted patch indices
+            keep = torch.ones(num_patches, dtype=torch.bool)
+            keep[[i for i in idx_mine if i < num_patches]] = False
+            indices = keep.nonzero().squeeze(1)
+            patch_indices = indices[torch.randperm(indices.numel())[:patch_take]]
+        else:
+            patch_indices = torch.randperm(num_patches)[:patch_take]
+        # only the selected cubes are copied out of the strided view
+        lr_patches, hr_patches = gather_cubes(patch_indices, lr_cubes, hr_cubes)
+        # patches are already in random order, so we read them sequentially
+        if pin_memory and num_workers == 0 and not lr_patches.is_cuda:
+            lr_patches = lr_patches.pin_memory()
+            hr_patches = hr_patches.pin_memory()
+        patches = Patch(lr_patches, hr_patches)
         patch_loader = torch.utils.data.DataLoader(dataset=patches, 
-                                        batch_size=patch_size, 
-                                        sampler=patch_sampler,
-                                        shuffle=False)
+                                        batch_size=None,
+                                        sampler=PatchBatchSampler(len(patches), patch_size),
+                                        **loader_kwargs)
         return patch_loader
     else:
         stride = cube_size- 2 * margin # patch stride, when merging patches, we need to reduce stride for we need to give up the margin to avoid margin effect.
         padding=[20, 17, 17] # calculate how many paddings we need to care for edges of images, for simplicity, the numbers are pre-calculated by default patch size, for different size of input, it should be different.
-        # Padding
-        lr_data_padded = torch.zeros([lr_data.shape[0] ,lr_data.shape[1] + 2 * padding[0],lr_data.shape[2]+ 2 * padding[1],lr_data.shape[3] + 2 * padding[2]])
-        hr_data_padded = torch.zeros([lr_data.shape[0] ,hr_data.shape[1] + 2 * padding[0],hr_data.shape[2]+ 2 * padding[1],hr_data.shape[3] + 2 * padding[2]])
-        lr_data_padded[:, padding[0]: lr_data.shape[1]+padding[0], padding[1]: lr_data.shape[2]+padding[1], 
-                       padding[2]: lr_data.shape[3]+padding[2]] = lr_data
-        hr_data_padded[:, padding[0]: hr_data.shape[1]+padding[0], padding[1]: hr_data.shape[2]+padding[1], 
-                       padding[2]: hr_data.shape[3]+padding[2]] = hr_data
-        lr_patches = lr_data_padded.unfold(1, cube_size, stride).unfold(2, cube_size, stride).unfold(3, cube_size, stride)
-        hr_patches = hr_data_padded.unfold(1, cube_size, stride).unfold(2, cube_size, stride).unfold(3, cube_size, stride)
-        lr_patches = lr_patches.contiguous().view(-1, cube_size, cube_size, cube_size)
-        hr_patches = hr_patches.contiguous().view(-1, cube_size, cube_size, cube_size)
+        lr_patches, hr_patches = build_eval_patches(lr_data, hr_data, cube_size, stride, tuple(padding))
+        if pin_memory and num_workers == 0 and not lr_patches.is_cuda:
+            lr_patches = lr_patches.pin_memory()
+            hr_patches = hr_patches.pin_memory()
         patches = Patch(lr_patches, hr_patches)
         patch_loader = torch.utils.data.DataLoader(dataset=patches, 
-                                        batch_size=patch_size, 
-                                        sampler=None,
-                                        shuffle=False)
+                                        batch_size=None,
+                                        sampler=PatchBatchSampler(len(patches), patch_size),
+                                        **loader_kwargs)
         return patch_loader
 
+def merge_cubes(cubes):
+    '''
+    This function merges cubes (B,nz,nx,ny,c,c,c) into one image (B,nz*c,nx*c,ny*c) with a single copy.
+    
+    '''
+    B, nz, nx, ny, cz, cx, cy = cubes.shape
+    # (B,nz,nx,ny,c,c,c) -> (B,nz,c,nx,c,ny,c) -> (B,nz*c,nx*c,ny*c)
+    return cubes.permute(0, 1, 4, 2, 5, 3, 6).reshape(B, nz * cz, nx * cx, ny * cy)
+
+# the shapes are fixed in this project, so the merging copy is compiled into one shape-specialized kernel.
+merge_cubes = torch.compile(merge_cubes, fullgraph=True, dynamic=False)
+
 def depatching(patches, batch_size, margin = 3, image_size = [192,320,320]):
     '''
     This function merges patches to the original 3D image. Note that this function based on tensor, but detached. 
@@ -111,30 +271,18 @@ def depatching(patches, batch_size, margin = 3, image_size = [192,320,320]):
     cube_size_cropped = real_tmp.shape[-1]
     merged_image_size=[image_size[0]+2*(padding[0]-margin),image_size[1]+2*(padding[1]-margin),
                        image_size[2]+2*(padding[2]-margin)]
-    merged_image = torch.zeros(batch_size, merged_image_size[0], merged_image_size[1], merged_image_size[2])
     nz = int(merged_image_size[0] / cube_size_cropped)
     nx = int(merged_image_size[1] / cube_size_cropped)
     ny = int(merged_image_size[2] / cube_size_cropped)
-    real_tmp = real_tmp.view(batch_size, nz, -1, cube_size_cropped, cube_size_cropped, cube_size_cropped)
-    print('################### real tmp 6D ####################')
-    print(real_tmp.size())
-
-    real_tmp = real_tmp.view(batch_size, nz, nx, -1, cube_size_cropped, cube_size_cropped, cube_size_cropped)
-    print('################### real tmp 7D ####################')
-    print(real_tmp.size())
-    image = torch.zeros(batch_size, image_size[0], image_size[1], image_size[2])
-    print('################# cube_size_cropped ###############')
-    #print(cube_size_cropped.size())
-
-    for i in range(nz):
-        for j in range(nx):
-            for k in range(ny):
-                
-                merged_image[:,cube_size_cropped*i:cube_size_cropped*(i+1), cube_size_cropped*j:cube_size_cropped*(j+1), 
-                             cube_size_cropped*k:cube_size_cropped*(k+1)] = real_tmp[:,i,j,k,:,:,:] 
-    print('3333333 merged_image 3333333')
-    #print(merged_image.size())
+    real_tmp = real_tmp.view(batch_size, nz, nx, ny, cube_size_cropped, cube_size_cropped, cube_size_cropped)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('depatching %s patches of dtype %s into cubes %s', tuple(patches.shape), patches.dtype, tuple(real_tmp.shape))
+    merged_image = merge_cubes(real_tmp)
+    # the part of merged image not covered by any cube stays zero
+    rest = [merged_image_size[0] - merged_image.shape[1], merged_image_size[1] - merged_image.shape[2], 
+            merged_image_size[2] - merged_image.shape[3]]
+    if any(rest):
+        merged_image = F.pad(merged_image, (0, rest[2], 0, rest[1], 0, rest[0]))
     image=merged_image[:,(padding[0]-margin):-(padding[0]-margin),(padding[1]-margin):-(padding[1]-margin),
                        (padding[2]-margin):-(padding[2]-margin)]
-    #print(image.size())
     return image
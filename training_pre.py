@@ -15,7 +15,7 @@ import torchvision
 from torchvision import datasets, models, transforms
 import torchvision.utils as vutils
 from ecbm6040.dataloader.CustomDatasetFromCSV import CustomDatasetFromCSV
-from ecbm6040.patching.patchloader import patching
+from ecbm6040.patching.patchloader import patching, CudaPrefetcher
 
 def training_pre(model, dataloaders, dataset_sizes,
                  criterion, device, ngpu,
@@ -39,6 +39,8 @@ def training_pre(model, dataloaders, dataset_sizes,
         pretrained (string) - the root of the saved pretrained model. 
     """
     since = time.time()
+    # channels_last_3d weights let cuDNN pick the NDHWC conv3d kernels, the layout is kept by load_state_dict
+    model = model.to(memory_format=torch.channels_last_3d)
     optimizer = optim.Adam(model.parameters(), lr=lr)
     print ("Generator pre-training...")
     if pretrained != ' ':
@@ -68,9 +70,7 @@ def training_pre(model, dataloaders, dataset_sizes,
                                       usage=usage, is_training=True)
                 patch_count = 0
                 patch_loss = 0.0
-                for lr_patches, hr_patches in patch_loader:
-                    lr_patches=lr_patches.cuda(device)
-                    hr_patches=hr_patches.cuda(device)
+                for lr_patches, hr_patches in CudaPrefetcher(patch_loader, device):
                     # zero the parameter gradients
                     optimizer.zero_grad()
                     